@@ -1,28 +1,93 @@
 #!/usr/bin/env python3
 
 import argparse
+import calendar
 import functools
 import hashlib
+import html
 import json
 import logging
+import os
 import re
+import signal
 import sys
+import tempfile
 import time
-from dataclasses import asdict, dataclass
-from datetime import datetime, timedelta
+from collections import deque
+from dataclasses import dataclass, fields
 
 import requests
-from bs4 import BeautifulSoup as bs
 from influxdb import InfluxDBClient
-
-from dehumanise import human2bytes
+from influxdb.exceptions import InfluxDBClientError
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# the router reports data usage like "1.23 GB", in binary multiples
+DATA_SIZE_PATTERN = re.compile(r"([\d.]+)\s*([A-Za-z]+)")
+# the same symbols the old dehumanise recipe accepted, with "k" as an alias for "K"
+DATA_SIZE_MULTIPLIERS = {
+    symbol: 1 << (power * 10)
+    for symbols in (
+        ("B", "K", "MB", "GB", "TB", "PB", "E", "Z", "Y"),
+        ("byte", "kilo", "mega", "giga", "tera", "peta", "exa", "zetta", "iotta"),
+        ("Bi", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi", "Yi"),
+        ("byte", "kibi", "mebi", "gibi", "tebi", "pebi", "exbi", "zebi", "yobi"),
+    )
+    for power, symbol in enumerate(symbols)
+} | {"k": 1 << 10}
+
+
+def human2bytes(value: str) -> int:
+    """
+    Convert a size like "1.23 GB" to bytes.
+    When the unit isn't recognised ValueError is raised.
+
+      >>> human2bytes('0 B')
+      0
+      >>> human2bytes('1 K')
+      1024
+      >>> human2bytes('1.5 GB')
+      1610612736
+      >>> human2bytes('1 Gi')
+      1073741824
+      >>> human2bytes('0.5kilo')
+      512
+      >>> human2bytes('12')
+      Traceback (most recent call last):
+          ...
+      ValueError: can't interpret '12'
+      >>> human2bytes('1 Gb')
+      Traceback (most recent call last):
+          ...
+      ValueError: can't interpret '1 Gb'
+    """
+    match = DATA_SIZE_PATTERN.fullmatch(value.strip())
+    if match is None or match.group(2) not in DATA_SIZE_MULTIPLIERS:
+        raise ValueError(f"can't interpret {value!r}")
+    return int(float(match.group(1)) * DATA_SIZE_MULTIPLIERS[match.group(2)])
 
 
 class PlusnetHubOne:
     CONN_INFO_SUFFIX = "?active_page=9143"
+    # saved cookies older than this have probably expired on the router anyway
+    MAX_COOKIE_AGE = 5 * 60
     REBOOT_TIME_PATTERN = re.compile(r"wait = (\d*);")
+    FIRMWARE_UPDATED_PATTERN = re.compile(r"Last updated (\d{2}/\d{2}/\d{2})")
+    TOO_MANY_SESSIONS_PATTERN = re.compile(
+        r"No more than 100 sessions at a time are allowed\. Please wait until open sessions expire\."
+    )
+    # hacky way to check if we are logged in
+    PASSWORD_PROTECTED_PATTERN = re.compile(r"password protected")
 
-    session = requests.Session()
+    # every stat we want lives in a "<td>N. Label:</td><td>value</td>" row
+    ROW_PATTERN = re.compile(
+        r"<td[^>]*>\s*(\d+)\.[^<]*:</td>\s*<td[^>]*>(.*?)</td>", re.DOTALL
+    )
+    # the numbered rows collect_stats reads
+    STATS_ROWS = frozenset({3, 6, 7, 8, 9, 10, 11})
+    TAG_PATTERN = re.compile(r"<[^>]+>")
+    AUTH_KEY_PATTERN = re.compile(r'<input[^>]*name="auth_key"[^>]*value="([^"]*)"')
+    POST_TOKEN_PATTERN = re.compile(r'<input[^>]*name="post_token"[^>]*value="([^"]*)"')
 
     @dataclass(kw_only=True)
     class Stats:
@@ -47,35 +112,129 @@ class PlusnetHubOne:
         signal_attenuation_tx: float
         signal_attenuation_rx: float
 
-    def __init__(self, password: str, router_ip: str):
-        self.password = password
+    def __init__(self, password: str, router_ip: str, cookie_path: str | None = None):
+        self.password_bytes = password.encode()
         self.base_url = f"http://{router_ip}/index.cgi"
+        # firmware updates are rare, so remember the last date string we parsed
+        self.firmware_update_cache: tuple[str, int] = ("", 0)
+        # one session (and connection pool) per router, so several hubs can be polled side by side
+        self.session = requests.Session()
         # set timeout for all requests in session
         # see: https://github.com/psf/requests/issues/2011#issuecomment-490050252
         self.session.request = functools.partial(  # type: ignore
             self.session.request,
             timeout=3,
         )
+        # we only ever talk to the one router, so keep a single connection alive between polls
+        # and retry briefly if it's busy, rather than waiting for the next interval
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=2,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.2,
+                status_forcelist=[502, 503, 504],
+            ),
+        )
+        self.session.mount("http://", adapter)
+        self.session.headers.update(
+            {"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"}
+        )
+
+        self.cookie_path = cookie_path
+        # the session id currently in the cookie file, so we only rewrite it when it changes
+        self.saved_cookie: str | None = None
+        self.restored_session = self.load_cookies()
+
+    def load_cookies(self) -> bool:
+        if self.cookie_path is None:
+            return False
+
+        try:
+            if time.time() - os.path.getmtime(self.cookie_path) > self.MAX_COOKIE_AGE:
+                return False
+            with open(self.cookie_path) as cookie_file:
+                # keep the domain and path, so a new cookie from the router replaces the old one
+                for cookie in json.load(cookie_file):
+                    self.session.cookies.set(
+                        cookie["name"],
+                        cookie["value"],
+                        domain=cookie["domain"],
+                        path=cookie["path"],
+                    )
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            logging.warning(f"couldn't load saved cookies from {self.cookie_path}: {e}")
+            self.session.cookies.clear()
+            return False
+
+        logging.info(f"restored saved cookies from {self.cookie_path}")
+        self.saved_cookie = self.session.cookies.get("rg_cookie_session_id")
+        return True
+
+    def save_cookies(self) -> None:
+        if self.cookie_path is None:
+            return
+
+        # the session cookie is as good as the password, so keep it private: mkstemp creates a
+        # fresh 0600 file (never following symlinks), which then replaces the old one
+        cookie_dir = os.path.dirname(os.path.abspath(self.cookie_path))
+        try:
+            os.makedirs(cookie_dir, mode=0o700, exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=cookie_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as cookie_file:
+                    json.dump(
+                        [
+                            {
+                                "name": cookie.name,
+                                "value": cookie.value,
+                                "domain": cookie.domain,
+                                "path": cookie.path,
+                            }
+                            for cookie in self.session.cookies
+                        ],
+                        cookie_file,
+                    )
+                os.replace(temp_path, self.cookie_path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        except OSError as e:
+            logging.warning(f"couldn't save cookies to {self.cookie_path}: {e}")
+            return
+
+        self.saved_cookie = self.session.cookies.get("rg_cookie_session_id")
+
+    def touch_cookies(self) -> None:
+        # the saved cookie just worked, so restarts from now on can still use it
+        if self.cookie_path is None:
+            return
 
-    def login(self) -> None:
-        # will redirect to the login page first, if we aren't authenticated
-        login_page = self.session.get(self.base_url + self.CONN_INFO_SUFFIX)
+        try:
+            os.utime(self.cookie_path, follow_symlinks=False)
+        except OSError as e:
+            logging.debug(f"couldn't refresh saved cookies at {self.cookie_path}: {e}")
+
+    def login(self, login_text: str | None = None) -> requests.Response:
+        if login_text is None:
+            # will redirect to the login page first, if we aren't authenticated
+            login_text = self.session.get(self.base_url + self.CONN_INFO_SUFFIX).text
 
-        if (
-            "No more than 100 sessions at a time are allowed. Please wait until open sessions expire."
-            in login_page.text
-        ):
+        if self.TOO_MANY_SESSIONS_PATTERN.search(login_text):
             logging.fatal("too many sessions open, please wait")
             exit(1)
 
-        login_soup = bs(login_page.text, features="html.parser")
-
-        auth_key: str = login_soup.find("input", {"name": "auth_key"})["value"]  # type: ignore
-        post_token: str = login_soup.find("input", {"name": "post_token"})["value"]  # type: ignore
+        auth_key: str = self.AUTH_KEY_PATTERN.search(login_text).group(1)  # type: ignore
+        post_token: str = self.POST_TOKEN_PATTERN.search(login_text).group(1)  # type: ignore
 
         # the md5_pass value is the md5'd concatenation of the plaintext password and the auth_key (retrieved from the login form)
-        md5_pass: str = self.password + auth_key
-        md5_pass = hashlib.md5(md5_pass.encode()).hexdigest()
+        # not used for security on our side, which also lets it work on FIPS enabled systems
+        md5 = hashlib.md5(usedforsecurity=False)
+        md5.update(self.password_bytes)
+        md5.update(auth_key.encode())
+        md5_pass = md5.hexdigest()
 
         form_data = {
             "active_page": "9148",
@@ -85,64 +244,86 @@ class PlusnetHubOne:
             "auth_key": auth_key,
         }
 
-        # authorizes our cookie
-        self.session.post(self.base_url, data=form_data)
+        # authorizes our cookie, the response is normally the page we originally asked for
+        return self.session.post(self.base_url, data=form_data)
+
+    def is_stats_page(self, text: str) -> bool:
+        row_numbers = {int(match.group(1)) for match in self.ROW_PATTERN.finditer(text)}
+        return (
+            self.STATS_ROWS <= row_numbers
+            and self.REBOOT_TIME_PATTERN.search(text) is not None
+        )
+
+    def collect_stats(self, now: float) -> Stats:
+        conn_info_url = self.base_url + self.CONN_INFO_SUFFIX
+        conn_info_page = self.session.get(conn_info_url)
+        logging.debug(
+            f"conn info page content encoding: {conn_info_page.headers.get('Content-Encoding')}"
+        )
+        # Response.text decodes the body on every access, so only do it once
+        conn_info_text = conn_info_page.text
 
-    def collect_stats(self) -> Stats:
-        conn_info_page = self.session.get(self.base_url + self.CONN_INFO_SUFFIX)
-        conn_info_soup = bs(conn_info_page.text, features="html.parser")
+        # check this before doing any parsing, which would be wasted if we have to login again
+        for attempt in range(2):
+            cookie = self.session.cookies.get("rg_cookie_session_id")
+            if not self.PASSWORD_PROTECTED_PATTERN.search(conn_info_text):
+                break
+            if attempt > 0:
+                raise RuntimeError(f"still not authorized after logging in: {cookie}")
 
-        cookie = self.session.cookies.get_dict()["rg_cookie_session_id"]
-        # hacky way to check if we are logged in
-        if "password protected" in conn_info_page.text:
             logging.warning(f"cookie expired, must login again: {cookie}")
-            self.login()
-            return self.collect_stats()
+            # we've already been redirected to the login page, so reuse it
+            conn_info_text = self.login(conn_info_text).text
+            if not self.is_stats_page(conn_info_text):
+                conn_info_text = self.session.get(conn_info_url).text
 
         logging.info(f"authorized successfully with cookie: {cookie}")
+        # only a cookie that has just been seen to work gets saved
+        if cookie != self.saved_cookie:
+            self.save_cookies()
+        else:
+            self.touch_cookies()
+
+        rows = {
+            int(match.group(1)): html.unescape(
+                self.TAG_PATTERN.sub("", match.group(2))
+            ).strip()
+            for match in self.ROW_PATTERN.finditer(conn_info_text)
+        }
 
-        usage = conn_info_soup.find(
-            "td", text="11. Data sent/received:"
-        ).next_sibling.text.split("/")
+        usage = rows[11].split("/")
         transmitted, received = [human2bytes(value.strip()) for value in usage]
 
-        firmware_update_string = conn_info_soup.find(
-            "td", text="3. Firmware version:"
-        ).next_sibling.text.split("Last updated ")[1]
-        firmware_update_datetime = datetime.strptime(firmware_update_string, "%d/%m/%y")
+        firmware_update_string = self.FIRMWARE_UPDATED_PATTERN.search(rows[3]).group(1)  # type: ignore
+        if firmware_update_string == self.firmware_update_cache[0]:
+            firmware_update_datetime = self.firmware_update_cache[1]
+        else:
+            firmware_update_datetime = calendar.timegm(
+                time.strptime(firmware_update_string, "%d/%m/%y")
+            )
+            self.firmware_update_cache = (
+                firmware_update_string,
+                firmware_update_datetime,
+            )
 
-        seconds_since_reboot = self.REBOOT_TIME_PATTERN.search(conn_info_page.text).group(1)  # type: ignore
-        reboot_datetime = datetime.now() - timedelta(seconds=int(seconds_since_reboot))
+        seconds_since_reboot = self.REBOOT_TIME_PATTERN.search(conn_info_text).group(1)  # type: ignore
+        reboot_datetime = int(now - int(seconds_since_reboot))
 
-        data_rate_tx, data_rate_rx = conn_info_soup.find(
-            "td", text="6. Data rate:"
-        ).next_sibling.text.split("/")
+        data_rate_tx, data_rate_rx = rows[6].split("/")
 
-        max_data_rate_tx, max_data_rate_rx = conn_info_soup.find(
-            "td", text="7. Maximum data rate:"
-        ).next_sibling.text.split("/")
+        max_data_rate_tx, max_data_rate_rx = rows[7].split("/")
 
-        noise_margin_tx, noise_margin_rx = conn_info_soup.find(
-            "td", text="8. Noise margin:"
-        ).next_sibling.text.split("/")
+        noise_margin_tx, noise_margin_rx = rows[8].split("/")
 
-        line_attenuation_tx, line_attenuation_rx = conn_info_soup.find(
-            "td", text="9. Line attenuation:"
-        ).next_sibling.text.split("/")
+        line_attenuation_tx, line_attenuation_rx = rows[9].split("/")
 
-        signal_attenuation_tx, signal_attenuation_rx = conn_info_soup.find(
-            "td", text="10. Signal attenuation:"
-        ).next_sibling.text.split("/")
+        signal_attenuation_tx, signal_attenuation_rx = rows[10].split("/")
 
         return self.Stats(
             total_tx=transmitted,
             total_rx=received,
-            firmware_update_datetime=int(
-                time.mktime(firmware_update_datetime.timetuple()),
-            ),
-            reboot_datetime=int(
-                time.mktime(reboot_datetime.timetuple()),
-            ),
+            firmware_update_datetime=firmware_update_datetime,
+            reboot_datetime=reboot_datetime,
             data_rate_tx=int(data_rate_tx),
             data_rate_rx=int(data_rate_rx),
             max_data_rate_tx=int(max_data_rate_tx),
@@ -156,6 +337,22 @@ class PlusnetHubOne:
         )
 
 
+# Stats is flat, so reading the attributes directly avoids the deep copy done by asdict()
+STATS_FIELDS = tuple(field.name for field in fields(PlusnetHubOne.Stats))
+
+
+def to_line_protocol(stats: PlusnetHubOne.Stats, timestamp_ns: int) -> str:
+    # same encoding influxdb's make_lines would use: ints get an "i" suffix, floats use repr
+    field_set = []
+    for name in STATS_FIELDS:
+        value = getattr(stats, name)
+        if isinstance(value, int):
+            field_set.append(f"{name}={value}i")
+        else:
+            field_set.append(f"{name}={value!r}")
+    return f"data_stats {','.join(field_set)} {timestamp_ns}"
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="collect stats from a Plusnet Hub One router, and send them to InfluxDB",
@@ -192,54 +389,102 @@ def main():
         default=15,
         help="stats collection interval in seconds",
     )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=4,
+        help="number of collections to buffer before writing them to influxdb",
+    )
+    parser.add_argument(
+        "--cookie-file",
+        type=str,
+        default=os.path.join(
+            os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+            "plusnet-one-hub-influxdb",
+            "cookies.json",
+        ),
+        help="where to save the router session cookie, so restarts can skip logging in",
+    )
     parser.add_argument(
         "-v",
         "--verbose",
-        help="be verbose",
+        help="be verbose, repeat for debug output",
         dest="verbosity",
-        action="store_const",
-        const=logging.INFO,
+        action="count",
+        default=0,
     )
 
     args = parser.parse_args()
 
-    logging.basicConfig(level=args.verbosity, format="%(levelname)s: %(message)s")
+    log_level = [logging.WARNING, logging.INFO, logging.DEBUG][min(args.verbosity, 2)]
+    logging.basicConfig(level=log_level, format="%(levelname)s: %(message)s")
 
-    router = PlusnetHubOne(args.router_password, args.router_ip)
+    router = PlusnetHubOne(args.router_password, args.router_ip, args.cookie_file)
     # not strictly necessary, but prevents a warning message from being printed at startup
-    router.login()
-    print(
-        f"authorized for router at {args.router_ip}, with password {len(args.router_password) * '*'}"
-    )
+    # if the saved cookie has expired after all, collect_stats will login again
+    if router.restored_session:
+        print(
+            f"using saved session for router at {args.router_ip}, will login again if it has expired"
+        )
+    else:
+        router.login()
+        print(
+            f"authorized for router at {args.router_ip}, with password {len(args.router_password) * '*'}"
+        )
 
     client = InfluxDBClient(host=args.influxdb_url)
     print(f"connected to influxdb at {args.influxdb_url}")
 
     client.switch_database(args.influxdb_database)
 
-    while True:
-        start = time.perf_counter()
+    # if influxdb is down, hold on to at most a day of points (but always a full batch),
+    # dropping the oldest after that
+    pending_points: deque[str] = deque(
+        maxlen=max(args.batch_size, 24 * 60 * 60 // args.interval)
+    )
 
+    def flush_points() -> None:
         try:
-            stats = router.collect_stats()
-            logging.info(f"collected: {stats}")
-
-            client.write_points(
-                [
-                    {
-                        "measurement": "data_stats",
-                        "time": datetime.utcnow(),
-                        "fields": asdict(stats),
-                    }
-                ]
-            )
+            client.write_points(list(pending_points), protocol="line")
+            logging.info(f"wrote {len(pending_points)} points to influxdb")
+        except InfluxDBClientError as e:
+            # influxdb rejected the batch itself (4xx), so resending it would fail forever
+            logging.exception(e)
+            logging.error(f"dropping {len(pending_points)} points rejected by influxdb")
         except Exception as e:
+            # keep the buffered points, they'll be retried after the next collection
             logging.exception(e)
+            return
+        pending_points.clear()
 
-        logging.info(
-            f"took {time.perf_counter() - start:0.4f} seconds to collect stats"
-        )
-        time.sleep(args.interval)
+    # docker and systemd stop us with SIGTERM, treat it like ctrl-c so buffered points get written
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    try:
+        while True:
+            start = time.perf_counter()
+            now = time.time()
+
+            try:
+                stats = router.collect_stats(now)
+                logging.info(f"collected: {stats}")
+
+                # in nanoseconds, influxdb's default precision
+                pending_points.append(to_line_protocol(stats, int(now * 1e9)))
+            except Exception as e:
+                logging.exception(e)
+
+            if len(pending_points) >= args.batch_size:
+                flush_points()
+
+            logging.info(
+                f"took {time.perf_counter() - start:0.4f} seconds to collect stats"
+            )
+            # sleep for whatever is left of the interval, so collection time doesn't cause drift
+            time.sleep(max(0.0, args.interval - (time.perf_counter() - start)))
+    finally:
+        if pending_points:
+            flush_points()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+import hashlib
+import itertools
+import threading
+import time
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import pytest
+
+from exporter import PlusnetHubOne
+
+PASSWORD = "hunter2"
+
+STATS_PAGE = """<html><body><table>
+<tr><td>3. Firmware version:</td><td>SG4B1000B540<br>Last updated 01/02/22</td></tr>
+<tr><td>6. Data rate:</td><td>7000 / 50000</td></tr>
+<tr><td>7. Maximum data rate:</td><td>7500 / 55000</td></tr>
+<tr><td>8. Noise margin:</td><td>6.1 / 5.9</td></tr>
+<tr><td>9. Line attenuation:</td><td>12.5 / 20.3</td></tr>
+<tr><td>10. Signal attenuation:</td><td>12.4 / 20.1</td></tr>
+<tr><td>11. Data sent/received:</td><td>1.5&nbsp;GB / 3 MB</td></tr>
+</table><script>var wait = 3600;</script></body></html>"""
+
+LOGIN_PAGE = """<html><body><p>This page is password protected.</p><form>
+<input type="hidden" name="auth_key" value="{auth_key}">
+<input type="hidden" name="post_token" value="token">
+</form></body></html>"""
+
+
+class FakeRouter(ThreadingHTTPServer):
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeRouterHandler)
+        self.session_ids = itertools.count(1)
+        # session id -> [auth_key, authorized]
+        self.sessions: dict[str, list] = {}
+        self.logins = 0
+
+    @property
+    def address(self) -> str:
+        return f"127.0.0.1:{self.server_address[1]}"
+
+    def expire_sessions(self) -> None:
+        self.sessions.clear()
+
+
+class FakeRouterHandler(BaseHTTPRequestHandler):
+    server: FakeRouter
+
+    def log_message(self, *args):
+        pass
+
+    def session_id(self) -> str | None:
+        cookie = SimpleCookie(self.headers.get("Cookie", ""))
+        if "rg_cookie_session_id" in cookie:
+            return cookie["rg_cookie_session_id"].value
+        return None
+
+    def reply(self, body: str, session_id: str | None = None) -> None:
+        self.send_response(200)
+        if session_id is not None:
+            self.send_header("Set-Cookie", f"rg_cookie_session_id={session_id}; path=/")
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body.encode())))
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def reply_login_page(self) -> None:
+        session_id = f"s{next(self.server.session_ids)}"
+        auth_key = f"key-{session_id}"
+        self.server.sessions[session_id] = [auth_key, False]
+        self.reply(LOGIN_PAGE.format(auth_key=auth_key), session_id)
+
+    def do_GET(self):
+        session = self.server.sessions.get(self.session_id())
+        if session is not None and session[1]:
+            self.reply(STATS_PAGE)
+        else:
+            self.reply_login_page()
+
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        form = parse_qs(self.rfile.read(length).decode())
+        session = self.server.sessions.get(self.session_id())
+        if session is not None:
+            expected = hashlib.md5((PASSWORD + session[0]).encode()).hexdigest()
+            if form["md5_pass"] == [expected]:
+                session[1] = True
+                self.server.logins += 1
+                self.reply(STATS_PAGE)
+                return
+        self.reply_login_page()
+
+
+@pytest.fixture
+def router():
+    server = FakeRouter()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_collect_stats(router):
+    hub = PlusnetHubOne(PASSWORD, router.address)
+    stats = hub.collect_stats(time.time())
+
+    assert stats.total_tx == int(1.5 * (1 << 30))
+    assert stats.total_rx == 3 * (1 << 20)
+    assert stats.data_rate_rx == 50000
+    assert stats.noise_margin_tx == 6.1
+    assert router.logins == 1
+
+
+def test_restored_cookie_is_replaced_after_expiry(router, tmp_path):
+    cookie_path = str(tmp_path / "cookies.json")
+
+    first = PlusnetHubOne(PASSWORD, router.address, cookie_path)
+    assert not first.restored_session
+    first.collect_stats(time.time())
+    assert router.logins == 1
+
+    restarted = PlusnetHubOne(PASSWORD, router.address, cookie_path)
+    assert restarted.restored_session
+    restarted.collect_stats(time.time())
+    assert router.logins == 1
+
+    router.expire_sessions()
+    restarted.collect_stats(time.time())
+    restarted.collect_stats(time.time())
+    assert router.logins == 2
+
+    # the router's new cookie must have replaced the restored one, not sit beside it
+    assert [cookie.name for cookie in restarted.session.cookies] == [
+        "rg_cookie_session_id"
+    ]
+
+    # and the file now holds the new, working session
+    restarted_again = PlusnetHubOne(PASSWORD, router.address, cookie_path)
+    assert restarted_again.restored_session
+    restarted_again.collect_stats(time.time())
+    assert router.logins == 2
+
+
+def test_failed_login_does_not_save_cookie(router, tmp_path):
+    cookie_path = tmp_path / "cookies.json"
+
+    hub = PlusnetHubOne("wrong password", router.address, str(cookie_path))
+    with pytest.raises(RuntimeError):
+        hub.collect_stats(time.time())
+
+    assert not cookie_path.exists()